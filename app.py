@@ -10,15 +10,40 @@ if sys.platform == "win32":
         # Try to force the legacy selector loop which is sometimes more compatible
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     else:
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        try:
+            # winloop: uvloop-style C event loop for Windows
+            import winloop
+            winloop.install()
+        except ImportError:
+            # Selector loop (not Proactor) for aiodns/SSL compatibility
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 import chainlit as cl
+from cachetools import TTLCache
 from text2sql_agent import app_graph
-import plotly.io as pio
+from config import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
 import json
-import nest_asyncio
+import re
+
+# Cache of full agent responses, keyed on the normalized question. The TTL
+# makes sure changes to the underlying data are eventually picked up.
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def normalize_question(question: str) -> str:
+    """Lowercases and strips punctuation/extra whitespace from a question."""
+    return " ".join(re.sub(r"[^\w\s]", "", question.lower()).split())
+
+async def send_sql(sql_query: str):
+    await cl.Message(content=f"**Generated SQL:**\n```sql\n{sql_query}\n```").send()
 
-nest_asyncio.apply()
+async def send_graph(graph_json: str):
+    try:
+        # Imported here: plotly is heavy and only needed once a chart exists
+        import plotly.io as pio
+        fig = pio.from_json(graph_json)
+        await cl.Message(content="**Visualization:**", elements=[cl.Plotly(name="chart", figure=fig, display="inline")]).send()
+    except Exception as e:
+        await cl.Message(content=f"Error displaying graph: {e}").send()
 
 @cl.on_chat_start
 async def on_chat_start():
@@ -29,6 +54,17 @@ async def on_chat_start():
 async def on_message(message: cl.Message):
     graph = cl.user_session.get("graph")
     
+    # Repeated question: replay the stored response and skip the graph
+    cache_key = normalize_question(message.content)
+    cached = response_cache.get(cache_key)
+    if cached:
+        if cached["sql_query"]:
+            await send_sql(cached["sql_query"])
+        await cl.Message(content=cached["final_answer"]).send()
+        if cached["graph_json"]:
+            await send_graph(cached["graph_json"])
+        return
+    
     # Initialize state
     initial_state = {
         "question": message.content,
@@ -41,21 +77,48 @@ async def on_message(message: cl.Message):
         "graph_json": ""
     }
     
-    # Run the graph
-    res = await graph.ainvoke(initial_state)
-    
-    # Send the SQL query if available
-    if res.get("sql_query"):
-        await cl.Message(content=f"**Generated SQL:**\n```sql\n{res['sql_query']}\n```").send()
+    # Stream node updates so the answer and chart are shown as soon as
+    # their node finishes, instead of waiting for the whole graph. The
+    # "custom" stream carries the analysis tokens as they are generated.
+    res = {"sql_query": "", "query_result": "", "final_answer": "", "graph_json": ""}
+    sql_sent = False
+    failed = False
+    answer_msg = None
+    async for mode, chunk in graph.astream(initial_state, stream_mode=["updates", "custom"]):
+        if mode == "custom":
+            if "token" in chunk:
+                if answer_msg is None:
+                    if res["sql_query"] and not sql_sent:
+                        await send_sql(res["sql_query"])
+                        sql_sent = True
+                    answer_msg = cl.Message(content="")
+                await answer_msg.stream_token(chunk["token"])
+            continue
+        
+        for node, update in chunk.items():
+            update = update or {}
+            
+            for key in res:
+                if update.get(key):
+                    res[key] = update[key]
+            
+            # Send the SQL query once the graph has moved past execution
+            if node in ("analysis_agent", "chart_pipeline", "failure_agent") and res["sql_query"] and not sql_sent:
+                await send_sql(res["sql_query"])
+                sql_sent = True
+            
+            # Send the final answer (analysis, guardrail or failure reply)
+            failed = failed or node == "failure_agent"
+            if update.get("final_answer"):
+                if node == "analysis_agent" and answer_msg is not None:
+                    await answer_msg.send()
+                else:
+                    await cl.Message(content=update["final_answer"]).send()
+            
+            # Send the graph if available
+            if update.get("graph_json"):
+                await send_graph(update["graph_json"])
     
-    # Send the final answer
-    if res.get("final_answer"):
-        await cl.Message(content=res["final_answer"]).send()
-    
-    # Send the graph if available
-    if res.get("graph_json"):
-        try:
-            fig = pio.from_json(res["graph_json"])
-            await cl.Message(content="**Visualization:**", elements=[cl.Plotly(name="chart", figure=fig, display="inline")]).send()
-        except Exception as e:
-            await cl.Message(content=f"Error displaying graph: {e}").send()
+    # Failed queries are not cached, so asking again gets a fresh attempt
+    if res["final_answer"] and not failed:
+        response_cache[cache_key] = res
@@ -3,19 +3,47 @@ Configuration module for Text2SQL Agent.
 Handles GPU detection, path configuration, and LLM parameters.
 """
 import os
+import json
+import shutil
 import subprocess
+import time
 from pathlib import Path
 
 # Project root directory
 PROJECT_ROOT = Path(__file__).parent.absolute()
 
+# GPU detection cache (avoids spawning nvidia-smi on every start)
+GPU_CACHE_FILE = Path(os.getenv("XDG_CACHE_HOME", Path.home() / ".cache")) / "text2sql_agent" / "gpu.json"
+GPU_CACHE_TTL = 24 * 60 * 60  # seconds
+
+def _nvidia_driver_present():
+    """Cheap check for an NVIDIA driver, without spawning a process."""
+    if os.path.exists("/proc/driver/nvidia/version"):
+        return True
+    if os.name == 'nt' and os.path.exists(os.path.join(os.environ.get("SystemRoot", "C:/Windows"), "System32", "nvml.dll")):
+        return True
+    return shutil.which("nvidia-smi") is not None
+
 def detect_gpu():
     """
     Detect if NVIDIA GPU is available for acceleration.
     
+    The nvidia-smi result is cached on disk for 24h, and the subprocess is
+    skipped entirely when no NVIDIA driver is installed.
+    
     Returns:
         bool: True if GPU is detected, False otherwise
     """
+    if not _nvidia_driver_present():
+        return False
+    
+    try:
+        cached = json.loads(GPU_CACHE_FILE.read_text())
+        if time.time() - cached["checked_at"] < GPU_CACHE_TTL:
+            return cached["has_gpu"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    
     try:
         result = subprocess.run(
             ['nvidia-smi'], 
@@ -24,9 +52,16 @@ def detect_gpu():
             timeout=5,
             creationflags=subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
         )
-        return result.returncode == 0
+        has_gpu = result.returncode == 0
     except (subprocess.TimeoutExpired, FileNotFoundError, Exception):
-        return False
+        has_gpu = False
+    
+    try:
+        GPU_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        GPU_CACHE_FILE.write_text(json.dumps({"has_gpu": has_gpu, "checked_at": time.time()}))
+    except OSError:
+        pass
+    return has_gpu
 
 # GPU Detection
 HAS_GPU = detect_gpu()
@@ -38,16 +73,60 @@ DB_PATH = PROJECT_ROOT / DB_NAME
 # Ollama Configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
+# Smaller model for classification (graph-decision fallback)
+OLLAMA_FAST_MODEL = os.getenv("OLLAMA_FAST_MODEL", "llama3.2:1b")
+# How long Ollama keeps the models loaded after a request (e.g. "1h", "-1" = forever)
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "1h")
+# Load the models in the background at startup (1 = on)
+OLLAMA_WARMUP = os.getenv("OLLAMA_WARMUP", "1").lower() in ("1", "true", "yes")
 
 # LLM Parameters (optimized for speed)
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0"))
 LLM_NUM_PREDICT = int(os.getenv("LLM_NUM_PREDICT", "512"))
+# Classification answers are a few tokens long
+LLM_FAST_NUM_PREDICT = int(os.getenv("LLM_FAST_NUM_PREDICT", "32"))
+# A single SQL statement (also used for the combined scope + SQL JSON answer)
+LLM_SQL_NUM_PREDICT = int(os.getenv("LLM_SQL_NUM_PREDICT", "256"))
+# Context window: Ollama pre-allocates the KV cache for it, so keep it just
+# large enough for the biggest prompt (schema + rules + result preview)
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "4096"))
+# CPU threads for inference (0 = Ollama default, one per physical core)
+LLM_NUM_THREAD = int(os.getenv("LLM_NUM_THREAD", "0")) or None
+# Force CPU-only inference (1 = on); otherwise Ollama picks the GPU itself
+LLM_FORCE_CPU = os.getenv("LLM_FORCE_CPU", "0").lower() in ("1", "true", "yes")
+
+# Query Result Limits
+# Rows fetched per query (used for charts) and rows shown to the LLM
+MAX_RESULT_ROWS = int(os.getenv("MAX_RESULT_ROWS", "50"))
+RESULT_PREVIEW_ROWS = int(os.getenv("RESULT_PREVIEW_ROWS", "10"))
+RESULT_PREVIEW_CHARS = int(os.getenv("RESULT_PREVIEW_CHARS", "2000"))
+
+# Graph Decision
+# 0 = purely heuristic (no LLM call); 1 = ask the LLM when the result shape is ambiguous
+GRAPH_DECISION_LLM = os.getenv("GRAPH_DECISION_LLM", "0").lower() in ("1", "true", "yes")
 
 # Retry Configuration
-MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+# LLM corrections of a failing query before giving up (known column mix-ups
+# are fixed locally and do not count)
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "1"))
+
+# LLM Response Cache (exact prompt matches skip the LLM; only used when
+# LLM_TEMPERATURE is 0, otherwise cached answers would hide sampling)
+LLM_CACHE = os.getenv("LLM_CACHE", "1").lower() in ("1", "true", "yes")
+LLM_CACHE_PATH = PROJECT_ROOT / os.getenv("LLM_CACHE_PATH", ".llm_cache.db")
+
+# Response Cache (repeated questions skip the agent pipeline)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "600"))
+
+# Query Result Cache (identical SQL skips execution)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "256"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "300"))
+
+# Display configuration on import (set TEXT2SQL_VERBOSE=1)
+VERBOSE = os.getenv("TEXT2SQL_VERBOSE", "0").lower() in ("1", "true", "yes")
 
-# Display configuration on import
-if __name__ != "__main__":
+if VERBOSE and __name__ != "__main__":
     print("=" * 50)
     print("Text2SQL Agent Configuration")
     print("=" * 50)
@@ -55,6 +134,7 @@ if __name__ != "__main__":
     print(f"Database: {DB_PATH}")
     print(f"Ollama URL: {OLLAMA_BASE_URL}")
     print(f"Model: {OLLAMA_MODEL}")
+    print(f"Fast Model: {OLLAMA_FAST_MODEL}")
     print(f"Temperature: {LLM_TEMPERATURE}")
     print(f"Max Tokens: {LLM_NUM_PREDICT}")
     print("=" * 50)
@@ -1,6 +1,7 @@
 """
 Quick test to verify the optimized agent works
 """
+import asyncio
 from text2sql_agent import app_graph
 
 # Test with a simple query
@@ -15,11 +16,22 @@ test_state = {
     "graph_json": ""
 }
 
+async def run_streaming(state):
+    """Runs the graph, printing the analysis tokens as they are generated."""
+    result = {}
+    async for mode, chunk in app_graph.astream(state, stream_mode=["values", "custom"]):
+        if mode == "custom":
+            print(chunk.get("token", ""), end="", flush=True)
+        else:
+            result = chunk
+    print()
+    return result
+
 print("Testing optimized agent...")
 print("=" * 60)
 
 try:
-    result = app_graph.invoke(test_state)
+    result = asyncio.run(run_streaming(test_state))
     print("✅ SUCCESS!")
     print(f"\nSQL Query: {result.get('sql_query', 'None')}")
     print(f"\nFinal Answer: {result.get('final_answer', 'None')[:200]}...")
@@ -28,3 +40,28 @@ except Exception as e:
     print(f"❌ ERROR: {e}")
     import traceback
     traceback.print_exc()
+
+# Fan-out with a fully populated state (every key already set, as after a
+# previous turn): analysis_agent and chart_pipeline run in the same step and
+# must not both write a key
+print("\nTesting parallel analysis + chart with a populated state...")
+print("=" * 60)
+
+full_state = {
+    **test_state,
+    "question": "How many customers are there per state?",
+    "query_result_full": [],
+    "query_columns": [],
+    "graph_type": "none",
+    "final_answer": "previous answer",
+}
+
+try:
+    result = asyncio.run(run_streaming(full_state))
+    assert result.get("final_answer") != "previous answer", "final_answer was not replaced"
+    print("✅ SUCCESS!")
+    print(f"\nGraph Type: {result.get('graph_type', 'none')}")
+except Exception as e:
+    print(f"❌ ERROR: {e}")
+    import traceback
+    traceback.print_exc()
@@ -1,5 +1,4 @@
-from typing import TypedDict, Annotated, List, Union
-from typing_extensions import TypedDict
+from typing import TypedDict, Literal
 import os
 from dotenv import load_dotenv
 
@@ -8,28 +7,189 @@ load_dotenv()
 
 from langchain_ollama import OllamaLLM
 from langchain_community.utilities import SQLDatabase
+from langchain_community.cache import SQLiteCache
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
+from langchain_core.exceptions import OutputParserException
 from langgraph.graph import StateGraph, END
+from langgraph.config import get_stream_writer
+from pydantic import BaseModel
 import json
-import pandas as pd
-import plotly.express as px
-import plotly.io as pio
+import re
+import orjson
+import sqlite3
+import threading
+from sqlalchemy.pool import StaticPool
+from cachetools import TTLCache
 
 # Import configuration
 from config import (
     DB_PATH,
     OLLAMA_BASE_URL,
     OLLAMA_MODEL,
+    OLLAMA_FAST_MODEL,
+    OLLAMA_KEEP_ALIVE,
+    OLLAMA_WARMUP,
     LLM_TEMPERATURE,
     LLM_NUM_PREDICT,
+    LLM_FAST_NUM_PREDICT,
+    LLM_SQL_NUM_PREDICT,
+    LLM_NUM_CTX,
+    LLM_NUM_THREAD,
+    LLM_FORCE_CPU,
+    LLM_CACHE,
+    LLM_CACHE_PATH,
+    GRAPH_DECISION_LLM,
     MAX_RETRIES,
+    QUERY_CACHE_SIZE,
+    QUERY_CACHE_TTL,
+    MAX_RESULT_ROWS,
+    RESULT_PREVIEW_ROWS,
+    RESULT_PREVIEW_CHARS,
     HAS_GPU
 )
 
 # Initialize Database
-db = SQLDatabase.from_uri(f"sqlite:///{DB_PATH}")
+def connect_db():
+    """
+    Opens the SQLite connection shared by every query.
+    
+    The workload is read-only, so the connection is tuned for reads (WAL,
+    large page cache, memory-mapped I/O) and locked with query_only.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-200000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA query_only=1")
+    return conn
+
+def db_version() -> int:
+    try:
+        return os.stat(DB_PATH).st_mtime_ns
+    except OSError:
+        return 0
+
+# One connection for the whole process: execute_sql uses it directly, and
+# SQLDatabase (schema introspection) shares it through a StaticPool.
+# Chainlit sessions can run nodes on different threads, so access is locked
+# (re-entrant: reconnecting rebuilds the engine, which asks for the connection).
+CONN = None
+CONN_VERSION = None
+DB_LOCK = threading.RLock()
+db = None
+
+def get_connection(force: bool = False):
+    """
+    Returns the shared connection, reopening it when the database file was
+    replaced (db_init.py deletes and rewrites it; on POSIX an open connection
+    would keep reading the unlinked old file).
+    
+    Reopening also rebuilds the SQLDatabase engine, whose StaticPool holds
+    the previous connection.
+    """
+    global CONN, CONN_VERSION, db
+    with DB_LOCK:
+        if CONN is not None and not force and db_version() == CONN_VERSION:
+            return CONN
+        if CONN is not None:
+            CONN.close()
+        CONN = connect_db()
+        # Read after connecting: switching a fresh file to WAL touches it
+        CONN_VERSION = db_version()
+        db = SQLDatabase.from_uri(
+            f"sqlite:///{DB_PATH}",
+            engine_args={"creator": get_connection, "poolclass": StaticPool},
+        )
+        return CONN
+
+get_connection()
+
+def build_schema_info():
+    """
+    Builds a compact, token-efficient schema: one line per table.
+    
+    Example: TABLE orders(order_id TEXT, customer_id TEXT FK->customers.customer_id)
+    
+    Foreign keys come from PRAGMA foreign_key_list when declared; otherwise
+    an `<entity>_id` column is linked to the `<entity>s` table holding it.
+    """
+    tables = db.get_usable_table_names()
+    columns = {
+        table: db.run(f'PRAGMA table_info("{table}")', fetch="cursor").fetchall()
+        for table in tables
+    }
+    
+    lines = []
+    for table in tables:
+        declared = {
+            fk[3]: f"{fk[2]}.{fk[4]}"
+            for fk in db.run(f'PRAGMA foreign_key_list("{table}")', fetch="cursor").fetchall()
+        }
+        parts = []
+        # table_info rows: (cid, name, type, notnull, default, pk)
+        for _, name, col_type, _, _, pk in columns[table]:
+            part = f"{name} {col_type or 'TEXT'}"
+            if pk:
+                part += " PK"
+            ref = declared.get(name)
+            if ref is None and name.endswith("_id"):
+                target = name[:-3] + "s"
+                if target != table and target in columns and any(c[1] == name for c in columns[target]):
+                    ref = f"{target}.{name}"
+            if ref:
+                part += f" FK->{ref}"
+            parts.append(part)
+        lines.append(f"TABLE {table}({', '.join(parts)})")
+    return "\n".join(lines)
+
+# Cache the schema once - it is static between runs, so there is no need to
+# re-introspect SQLite on every LLM turn
+SCHEMA_INFO = build_schema_info()
+
+def refresh_schema():
+    """
+    Reopens the database and re-reads its schema (call after the database
+    is rebuilt).
+    """
+    global SCHEMA_INFO, SCOPE_RE
+    with DB_LOCK:
+        get_connection(force=True)
+        SCHEMA_INFO = build_schema_info()
+        SCOPE_RE = build_scope_re()
+        query_cache.clear()
+    return SCHEMA_INFO
+
+# Cache of query results, keyed on the canonicalized SQL and the database
+# version (file mtime, bumped whenever db_init.py re-populates the database)
+query_cache = TTLCache(maxsize=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL)
+
+SQL_LITERAL_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+def canonicalize_sql(query: str) -> str:
+    """Collapses whitespace and lowercases everything except string literals."""
+    parts = SQL_LITERAL_RE.split(query.strip().rstrip(";"))
+    # Odd indices are the quoted literals captured by the split
+    return "".join(
+        part if i % 2 else " ".join(part.split()).lower()
+        for i, part in enumerate(parts)
+    )
+
+# Exact-match cache for the deterministic classification/SQL calls. The key
+# is the full prompt (schema included), so a schema change misses the cache.
+llm_cache = SQLiteCache(database_path=str(LLM_CACHE_PATH)) if LLM_CACHE and LLM_TEMPERATURE == 0 else None
+
+# Runtime options shared by every model: GPU offload is left to Ollama,
+# which sizes it to the free VRAM and also sees Metal/ROCm (HAS_GPU only
+# detects NVIDIA), unless CPU-only inference is forced - and the KV cache
+# is sized to the prompts we send
+OLLAMA_OPTIONS = {
+    "num_gpu": 0 if LLM_FORCE_CPU else None,
+    "num_thread": LLM_NUM_THREAD,
+    "num_ctx": LLM_NUM_CTX,
+}
 
 # Initialize LLM with Ollama (local) - OPTIMIZED FOR SPEED
 llm = OllamaLLM(
@@ -37,13 +197,53 @@ llm = OllamaLLM(
     base_url=OLLAMA_BASE_URL,
     temperature=LLM_TEMPERATURE,
     num_predict=LLM_NUM_PREDICT,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+    **OLLAMA_OPTIONS,
+)
+
+# Small model with a tight token budget for the graph-decision fallback,
+# whose answer is a short JSON object (enforced by Ollama's JSON mode)
+llm_fast = OllamaLLM(
+    model=OLLAMA_FAST_MODEL,
+    base_url=OLLAMA_BASE_URL,
+    temperature=LLM_TEMPERATURE,
+    num_predict=LLM_FAST_NUM_PREDICT,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+    **OLLAMA_OPTIONS,
+    format="json",
+    cache=llm_cache,
+)
+
+# SQL answers get their own token budget and stop at the end of the statement
+# (";" followed by a newline, so a ";" inside a string literal is kept) or at
+# a closing markdown fence; clean_sql drops a trailing ";". num_predict is a
+# model option, not a call kwarg, hence model_copy rather than bind.
+llm_sql = llm.model_copy(update={"num_predict": LLM_SQL_NUM_PREDICT}).bind(stop=[";\n", "\n```"])
+
+# Same model in Ollama's JSON mode, for the combined scope + SQL call
+llm_json = OllamaLLM(
+    model=OLLAMA_MODEL,
+    base_url=OLLAMA_BASE_URL,
+    temperature=LLM_TEMPERATURE,
+    num_predict=LLM_SQL_NUM_PREDICT,
+    keep_alive=OLLAMA_KEEP_ALIVE,
+    **OLLAMA_OPTIONS,
+    format="json",
+    cache=llm_cache,
 )
 
 # --- State Definition ---
+class GraphDecision(BaseModel):
+    """Answer of the graph-decision LLM fallback."""
+    needs_graph: bool
+    graph_type: Literal["bar", "line", "pie", "scatter", "none"]
+
 class AgentState(TypedDict):
     question: str
     sql_query: str
-    query_result: str
+    query_result: str          # Compact preview of the result for the LLM prompts
+    query_result_full: list    # Fetched rows (up to MAX_RESULT_ROWS) for visualization
+    query_columns: list
     error: str
     iteration: int
     needs_graph: bool
@@ -52,51 +252,16 @@ class AgentState(TypedDict):
     final_answer: str
     is_in_scope: bool
 
-# --- Nodes ---
+class ChartOutput(TypedDict):
+    """Keys the chart sub-graph hands back to the main graph."""
+    needs_graph: bool
+    graph_type: str
+    graph_json: str
 
-def guardrail_agent(state: AgentState):
-    """Checks if the question is in scope or a greeting."""
-    print("--- Entered guardrail_agent ---")
-    question = state["question"]
-    
-    system = """You are a helpful assistant for an E-commerce database.
-    Determine if the user's question is:
-    1. A greeting (e.g., "hi", "hello") -> Return "GREETING"
-    2. A valid question about e-commerce data (orders, products, customers, etc.) -> Return "IN_SCOPE"
-    3. Out of scope (e.g., "who is the president", "weather") -> Return "OUT_OF_SCOPE"
-    
-    Only return one of these three strings.
-    """
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system),
-        ("user", "{question}")
-    ])
-    
-    chain = prompt | llm | StrOutputParser()
-    result = chain.invoke({"question": question}).strip()
-    print(f"Guardrail Result: {result}")
-    
-    if result == "GREETING":
-        return {"is_in_scope": False, "final_answer": "Hello! I can help you analyze your e-commerce data. Ask me about orders, products, or customers."}
-    elif result == "OUT_OF_SCOPE":
-        return {"is_in_scope": False, "final_answer": "I can only answer questions about the e-commerce database. Please ask about orders, sales, or products."}
-    else:
-        return {"is_in_scope": True}
+# --- Prompts & Chains ---
+# Built once at import time; nodes only call .ainvoke() with their variables
 
-def sql_agent(state: AgentState):
-    """Generates SQL query from natural language."""
-    print("--- Entered sql_agent ---")
-    question = state["question"]
-    schema = db.get_table_info()
-    
-    system = f"""You are an expert SQLite data analyst. 
-    Given the following database schema, generate a valid SQLite query to answer the user's question.
-    
-    Schema:
-    {schema}
-    
-    CRITICAL Rules:
+SQL_RULES = """CRITICAL Rules:
     1. Use EXACT column names from the schema above - do NOT invent column names
     2. For order_payments table, use 'payment_value' NOT 'price'
     3. For customer queries, include customer_city or customer_state for readable labels
@@ -104,89 +269,51 @@ def sql_agent(state: AgentState):
     5. If the query might return many rows, limit it to 10.
     6. Use valid SQLite syntax.
     """
+
+# Guardrail + SQL generation in one call, for questions the regex prefilter
+# cannot classify
+SCOPE_SQL_SYSTEM = """You are an expert SQLite data analyst for an E-commerce database.
+    First classify the user's message with exactly one letter:
+    G. A greeting (e.g., "hi", "hello")
+    I. A valid question about e-commerce data (orders, products, customers, etc.)
+    O. Out of scope (e.g., "who is the president", "weather")
     
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system),
-        ("user", "{question}")
-    ])
+    If it is I, also generate a valid SQLite query answering it, using this schema:
+    {schema}
     
-    chain = prompt | llm | StrOutputParser()
-    query = chain.invoke({"question": question}).strip()
+    """ + SQL_RULES + """
+    Respond with JSON only: {{"scope": "I", "sql": "SELECT ..."}}
+    Use an empty "sql" unless the scope is I.
+    """
+
+SQL_SYSTEM = """You are an expert SQLite data analyst. 
+    Given the following database schema, generate a valid SQLite query to answer the user's question.
     
-    # Clean up markdown if present
-    query = query.replace("```sql", "").replace("```", "").strip()
-    print(f"Generated Query: {query}")
+    Schema:
+    {schema}
     
-    return {"sql_query": query, "iteration": state.get("iteration", 0) + 1}
-
-def execute_sql(state: AgentState):
-    """Executes the SQL query."""
-    print("--- Entered execute_sql ---")
-    query = state["sql_query"]
-    try:
-        result = db.run(query)
-        print(f"Query Result: {str(result)[:100]}...")
-        # Store raw result for visualization, but keep string version for analysis
-        return {"query_result": result, "error": ""}
-    except Exception as e:
-        print(f"Query Error: {e}")
-        return {"error": str(e), "query_result": ""}
+    """ + SQL_RULES
 
-def error_agent(state: AgentState):
-    """Fixes SQL query based on error."""
-    print("--- Entered error_agent ---")
-    question = state["question"]
-    query = state["sql_query"]
-    error = state["error"]
-    
-    system = f"""You are fixing a broken SQL query.
+ERROR_SYSTEM = """You are fixing a broken SQL query.
     Question: {question}
     Original Query: {query}
     Error: {error}
     
     Database Schema:
-    {db.get_table_info()}
+    {schema}
     
     Return the corrected SQL query ONLY. No markdown.
     """
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("user", "Fix the query.")])
-    chain = prompt | llm | StrOutputParser()
-    new_query = chain.invoke({}).strip()
-    new_query = new_query.replace("```sql", "").replace("```", "").strip()
-    print(f"Corrected Query: {new_query}")
-    
-    return {"sql_query": new_query, "iteration": state["iteration"] + 1}
 
-def analysis_agent(state: AgentState):
-    """Explains the results in natural language."""
-    print("--- Entered analysis_agent ---")
-    question = state["question"]
-    query = state["sql_query"]
-    result = state["query_result"]
-    
-    system = f"""You are a data analyst. Explain the following database results in natural language to the user.
+ANALYSIS_SYSTEM = """You are a data analyst. Explain the following database results in natural language to the user.
     User Question: {question}
     SQL Query: {query}
     Result: {result}
     
     Provide a clear, concise answer. If the result is a list, summarize it.
     """
-    
-    prompt = ChatPromptTemplate.from_messages([("system", system), ("user", "Provide the analysis.")])
-    chain = prompt | llm | StrOutputParser()
-    answer = chain.invoke({})
-    print("Generated Answer")
-    
-    return {"final_answer": answer}
 
-def decide_graph_need(state: AgentState) -> AgentState:
-    """Decides if a graph visualization is needed."""
-    print("--- Entered decide_graph_need ---")
-    question = state["question"]
-    result = state["query_result"]
-    
-    system = """You are a data visualization expert. Analyze if a visualization would be helpful.
+GRAPH_SYSTEM = """You are a data visualization expert. Analyze if a visualization would be helpful.
 
 IMPORTANT: Return ONLY valid JSON, nothing else. No explanations, no markdown.
 
@@ -205,143 +332,489 @@ Question: "Top 10 customers by spending" → {{"needs_graph": true, "graph_type"
 Question: "Yearly revenue" → {{"needs_graph": true, "graph_type": "line"}}
 Question: "How many orders?" → {{"needs_graph": false, "graph_type": "none"}}
 """
+
+# Chains are built once at import. The schema is bound as a callable partial
+# so refresh_schema() is picked up without rebuilding them.
+def current_schema() -> str:
+    return SCHEMA_INFO
+
+SCOPE_SQL_CHAIN = ChatPromptTemplate.from_messages([
+    ("system", SCOPE_SQL_SYSTEM),
+    ("user", "{question}")
+]).partial(schema=current_schema) | llm_json | StrOutputParser()
+
+SQL_CHAIN = ChatPromptTemplate.from_messages([
+    ("system", SQL_SYSTEM),
+    ("user", "{question}")
+]).partial(schema=current_schema) | llm_sql | StrOutputParser()
+
+ERROR_CHAIN = ChatPromptTemplate.from_messages([
+    ("system", ERROR_SYSTEM),
+    ("user", "Fix the query.")
+]).partial(schema=current_schema) | llm_sql | StrOutputParser()
+
+ANALYSIS_CHAIN = ChatPromptTemplate.from_messages([
+    ("system", ANALYSIS_SYSTEM),
+    ("user", "Provide the analysis.")
+]) | llm | StrOutputParser()
+
+GRAPH_CHAIN = ChatPromptTemplate.from_messages([
+    ("system", GRAPH_SYSTEM),
+    ("user", "Question: {question}\nResult: {result}\n\nReturn JSON:")
+]) | llm_fast | PydanticOutputParser(pydantic_object=GraphDecision)
+
+# --- Nodes ---
+
+# Guardrail prefilter: obvious greetings and domain questions skip the LLM
+GREETING_RE = re.compile(
+    r"^\s*(hi|hello|hey|yo|greetings|good (morning|afternoon|evening)|thanks|thank you|bye)"
+    r"( there| bot)?[\s!.,?]*$",
+    re.I,
+)
+DOMAIN_KEYWORDS = (
+    r"orders?|customers?|products?|sellers?|payments?|reviews?|revenue|sales?|"
+    r"freight|deliver(y|ies|ed)|shipping|categor(y|ies)|installments?|purchases?"
+)
+
+def plural_pattern(word: str) -> str:
+    """Regex matching the singular and plural of an English noun (city -> cit(y|ies))."""
+    if word.endswith("ies"):
+        word = word[:-3] + "y"
+    elif word.endswith("s") and not word.endswith(("ss", "us")):
+        word = word[:-1]
+    if re.search(r"[^aeiou]y$", word):
+        return re.escape(word[:-1]) + "(y|ies)"
+    if word.endswith(("s", "x", "z", "ch", "sh")):
+        return re.escape(word) + "(es)?"
+    return re.escape(word) + "s?"
+
+def build_scope_re():
+    """
+    Compiles the domain-keyword pattern from the fixed keywords plus the
+    multi-word table and column names ("order_items", "payment value").
+    
+    Single words split out of the names are left out: generic ones such as
+    "items" would accept off-topic questions ("items to pack for a trip").
+    """
+    names = set()
+    for table in db.get_usable_table_names():
+        names.add(table.lower())
+        names.update(
+            column[1].lower()
+            for column in db.run(f'PRAGMA table_info("{table}")', fetch="cursor").fetchall()
+        )
+    # Plural-insensitive on the last word: "order_items" also matches
+    # "order item", "customer_city" also "customer cities"
+    terms = "|".join(
+        r"[_ ]".join([*map(re.escape, name.split("_")[:-1]), plural_pattern(name.split("_")[-1])])
+        for name in sorted(names)
+        if "_" in name
+    )
+    return re.compile(rf"\b({DOMAIN_KEYWORDS}{'|' + terms if terms else ''})\b", re.I)
+
+SCOPE_RE = build_scope_re()
+# Clearly off-topic requests. A question matching both this and SCOPE_RE
+# ("a joke about orders") is left to the LLM.
+OUT_OF_SCOPE_RE = re.compile(
+    r"\b(weather|president|prime minister|jokes?|poems?|songs?|recipes?|news|capital of|translate)\b",
+    re.I,
+)
+
+GREETING_ANSWER = (
+    "Hello! I can help you analyze your e-commerce data. "
+    "Ask me about orders, products, or customers."
+)
+OUT_OF_SCOPE_ANSWER = (
+    "I can only answer questions about the e-commerce database. "
+    "Please ask about orders, sales, or products."
+)
+QUERY_FAILED_ANSWER = (
+    "I couldn't answer this question - the generated query failed with:\n`{error}`\n\n"
+    "Try rephrasing it, for example by naming the data you are interested in."
+)
+
+def clean_sql(text: str) -> str:
+    """Strips markdown fences (and a trailing semicolon) from generated SQL."""
+    return text.replace("```sql", "").replace("```", "").strip().rstrip(";").strip()
+
+# One-letter scope codes of the combined scope + SQL call
+SCOPE_CODES = {"G": "GREETING", "I": "IN_SCOPE", "O": "OUT_OF_SCOPE"}
+
+async def guardrail_agent(state: AgentState):
+    """
+    Checks if the question is in scope or a greeting.
+    
+    Obvious cases (greeting, domain keyword, clearly off-topic - but not a
+    mix of the last two) are decided by precompiled regexes in microseconds.
+    Otherwise one LLM call returns both the scope and, when in scope, the SQL
+    query - saving the separate sql_agent round-trip.
+    """
+    print("--- Entered guardrail_agent ---")
+    question = state["question"]
+    
+    sql_query = ""
+    in_scope = SCOPE_RE.search(question)
+    off_topic = OUT_OF_SCOPE_RE.search(question)
+    if GREETING_RE.match(question):
+        result = "GREETING"
+    elif in_scope and not off_topic:
+        result = "IN_SCOPE"
+    elif off_topic and not in_scope:
+        result = "OUT_OF_SCOPE"
+    else:
+        # Ambiguous - let the LLM decide, generating the SQL in the same call
+        try:
+            decision = extract_json(await SCOPE_SQL_CHAIN.ainvoke({"question": question}))
+            # First letter, so a spelled-out scope is understood as well
+            code = str(decision.get("scope") or "I").strip().upper()[:1]
+            result = SCOPE_CODES.get(code, "IN_SCOPE")
+            sql_query = clean_sql(str(decision.get("sql") or ""))
+        except Exception as e:
+            print(f"Error parsing guardrail decision: {e}")
+            result = "IN_SCOPE"
+    print(f"Guardrail Result: {result}")
     
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system),
-        ("user", f"Question: {question}\nResult: {result}\n\nReturn JSON:")
-    ])
+    if result == "GREETING":
+        return {"is_in_scope": False, "final_answer": GREETING_ANSWER}
+    elif result == "OUT_OF_SCOPE":
+        return {"is_in_scope": False, "final_answer": OUT_OF_SCOPE_ANSWER}
+    elif sql_query:
+        print(f"Generated Query: {sql_query}")
+        return {"is_in_scope": True, "sql_query": sql_query, "iteration": state.get("iteration", 0) + 1}
+    else:
+        return {"is_in_scope": True}
+
+async def sql_agent(state: AgentState):
+    """Generates SQL query from natural language."""
+    print("--- Entered sql_agent ---")
+    question = state["question"]
     
-    chain = prompt | llm | StrOutputParser()
-    response = chain.invoke({}).strip()
+    query = await SQL_CHAIN.ainvoke({"question": question})
     
-    print(f"Raw LLM Response: {response}")
+    # Clean up markdown if present
+    query = clean_sql(query)
+    print(f"Generated Query: {query}")
     
+    return {"sql_query": query, "iteration": state.get("iteration", 0) + 1}
+
+def format_result_preview(columns, rows):
+    """
+    Renders the first RESULT_PREVIEW_ROWS rows as compact JSON lines
+    (header first) to keep the LLM prompts small. Rows stop once the
+    preview reaches RESULT_PREVIEW_CHARS, so wide rows cannot blow it up.
+    """
+    if not rows:
+        return "(no rows)"
+    lines = [json.dumps(columns, default=str)]
+    size = len(lines[0])
+    shown = 0
+    for row in rows[:RESULT_PREVIEW_ROWS]:
+        line = json.dumps(list(row), default=str)
+        if shown and size + len(line) > RESULT_PREVIEW_CHARS:
+            break
+        if len(line) > RESULT_PREVIEW_CHARS:
+            line = line[:RESULT_PREVIEW_CHARS] + "...[truncated]"
+        lines.append(line)
+        size += len(line) + 1
+        shown += 1
+    if len(rows) > shown:
+        more = "+" if len(rows) >= MAX_RESULT_ROWS else ""
+        lines.append(f"... ({len(rows) - shown}{more} more rows)")
+    return "\n".join(lines)
+
+def execute_sql(state: AgentState):
+    """
+    Executes the SQL query.
+    
+    Kept synchronous on purpose: LangGraph runs sync nodes in a worker
+    thread, so the blocking sqlite3 call never stalls the event loop.
+    """
+    print("--- Entered execute_sql ---")
+    query = state["sql_query"]
+    cache_key = (canonicalize_sql(query), db_version())
     try:
-        # Clean response - remove markdown if present
-        if "```json" in response:
-            response = response.split("```json")[1].split("```")[0].strip()
-        elif "```" in response:
-            response = response.split("```")[1].split("```")[0].strip()
-        
-        decision = json.loads(response)
-        print(f"Graph Decision: {decision}")
-        return {"needs_graph": decision.get("needs_graph", False), "graph_type": decision.get("graph_type", "none")}
+        if cache_key in query_cache:
+            print("Query Result: (cached)")
+            columns, rows = query_cache[cache_key]
+        else:
+            # Fetch at most MAX_RESULT_ROWS rows instead of materializing
+            # (and stringifying) the whole result set. The raw sqlite3 cursor
+            # returns plain tuples, skipping SQLAlchemy's Row wrappers.
+            with DB_LOCK:
+                cursor = get_connection().execute(query)
+                try:
+                    columns = [col[0] for col in cursor.description] if cursor.description else []
+                    rows = cursor.fetchmany(MAX_RESULT_ROWS) if columns else []
+                finally:
+                    cursor.close()
+            query_cache[cache_key] = (columns, rows)
+            print(f"Query Result: {str(rows)[:100]}...")
+        # Full rows for visualization, compact preview for the LLM prompts
+        return {
+            "query_result": format_result_preview(columns, rows),
+            "query_result_full": rows,
+            "query_columns": columns,
+            "error": "",
+        }
     except Exception as e:
-        print(f"Error parsing graph decision: {e}")
-        return {"needs_graph": False, "graph_type": "none"}
-
-# PARALLEL EXECUTION OPTIMIZATION
-# This node runs analysis_agent and decide_graph_need in parallel for 15-25% speedup
-async def parallel_analysis_and_graph_decision(state: AgentState) -> AgentState:
-    """Runs analysis and graph decision in parallel to save time."""
-    print("--- Entered parallel_analysis_and_graph_decision ---")
+        print(f"Query Error: {e}")
+        return {"error": str(e), "query_result": "", "query_result_full": [], "query_columns": []}
+
+NO_SUCH_COLUMN_RE = re.compile(r"no such column: (?:(\w+)\.)?(\w+)", re.I)
+# Column mix-ups the SQL rules already warn about:
+# (table, wrong column) -> schema column
+KNOWN_COLUMN_FIXES = {
+    ("order_payments", "price"): "payment_value",
+}
+
+def qualifier_table(query: str, qualifier: str, table: str) -> bool:
+    """Tells whether `qualifier` refers to `table` (its name or an alias of it)."""
+    if qualifier.lower() == table:
+        return True
+    alias_re = rf"\b{re.escape(table)}\s+(?:AS\s+)?{re.escape(qualifier)}\b"
+    return re.search(alias_re, query, re.I) is not None
+
+def lint_sql(query: str, error: str):
+    """
+    Applies a deterministic fix for known errors, without an LLM call.
     
-    import asyncio
-    from concurrent.futures import ThreadPoolExecutor
+    Only a qualified column the error names as missing (e.g. "no such column:
+    p.price" with p an alias of order_payments) is rewritten, and only as an
+    unquoted identifier outside string literals - aliases such as "AS price"
+    and order_items.price stay untouched.
     
-    # Create executor for running sync functions in parallel
-    executor = ThreadPoolExecutor(max_workers=2)
-    loop = asyncio.get_event_loop()
+    Returns:
+        str: The repaired query, or None when no rule applies
+    """
+    match = NO_SUCH_COLUMN_RE.search(error or "")
+    if not match or not match.group(1):
+        return None
+    qualifier, column = match.groups()
+    fixes = [
+        fixed_column
+        for (table, wrong), fixed_column in KNOWN_COLUMN_FIXES.items()
+        if wrong == column.lower() and qualifier_table(query, qualifier, table)
+    ]
+    if not fixes:
+        return None
+    
+    pattern = re.compile(rf'(?<![\w."]){re.escape(qualifier)}\.{re.escape(column)}\b(?!")', re.I)
+    # Even parts are SQL, odd parts are the string literals matched by the split
+    parts = SQL_LITERAL_RE.split(query)
+    fixed = "".join(
+        pattern.sub(f"{qualifier}.{fixes[0]}", part) if i % 2 == 0 else part
+        for i, part in enumerate(parts)
+    )
+    return fixed if fixed != query else None
+
+async def error_agent(state: AgentState):
+    """Fixes SQL query based on error."""
+    print("--- Entered error_agent ---")
     
-    # Run both functions in parallel
-    analysis_future = loop.run_in_executor(executor, analysis_agent, state)
-    graph_future = loop.run_in_executor(executor, decide_graph_need, state)
+    # Known mistakes are rewritten locally; this does not use up a retry
+    fixed_query = lint_sql(state["sql_query"], state["error"])
+    if fixed_query:
+        print(f"Corrected Query (lint): {fixed_query}")
+        return {"sql_query": fixed_query}
+    
+    new_query = (await ERROR_CHAIN.ainvoke({
+        "question": state["question"],
+        "query": state["sql_query"],
+        "error": state["error"],
+    })).strip()
+    new_query = clean_sql(new_query)
+    print(f"Corrected Query: {new_query}")
     
-    # Wait for both to complete
-    analysis_result, graph_result = await asyncio.gather(analysis_future, graph_future)
+    return {"sql_query": new_query, "iteration": state["iteration"] + 1}
+
+async def analysis_agent(state: AgentState):
+    """
+    Explains the results in natural language.
     
-    # Merge results
-    merged = {**analysis_result, **graph_result}
-    print(f"Parallel execution complete: analysis={bool(analysis_result)}, graph={bool(graph_result)}")
+    Tokens are forwarded as they are generated through the graph's
+    "custom" stream ({"token": ...}), so the UI can display them live.
+    """
+    print("--- Entered analysis_agent ---")
+    writer = get_stream_writer()
+    
+    answer = ""
+    async for token in ANALYSIS_CHAIN.astream({
+        "question": state["question"],
+        "query": state["sql_query"],
+        "result": state["query_result"],
+    }):
+        answer += token
+        writer({"token": token})
+    print("Generated Answer")
     
-    return merged
+    return {"final_answer": answer}
+
+# Whole name parts only: "order_year" is a date, "days_to_deliver" and
+# "runtime" are not
+DATE_COLUMN_RE = re.compile(
+    r"(^|[_\W])(date|datetime|time|timestamp|year|month|day|week|quarter|period)([_\W]|$)", re.I
+)
+DATE_VALUE_RE = re.compile(r"^\d{4}(-\d{1,2}){0,2}([ T].*)?$")
+SHARE_COLUMN_RE = re.compile(r"share|percent|pct|ratio|proportion|fraction", re.I)
+# Chart intent stated in the question
+TREND_QUESTION_RE = re.compile(
+    r"\b(yearly|monthly|weekly|daily|trends?|over time|(per|by) (year|month|week|day))\b", re.I
+)
+SHARE_QUESTION_RE = re.compile(r"\b(share|percentage|percent|proportion|breakdown|split)\b", re.I)
+CORRELATION_QUESTION_RE = re.compile(r"\b(correlat\w*|relationship|vs\.?|versus)\b", re.I)
+
+def is_numeric(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
 
-# Wrapper for sync context
-def parallel_analysis_and_graph_decision_sync(state: AgentState) -> AgentState:
-    """Synchronous wrapper for parallel execution."""
-    import asyncio
+def heuristic_graph_decision(columns, rows, question=""):
+    """
+    Picks a chart from the question wording and the shape of the result,
+    without an LLM call.
+    
+    Returns:
+        dict: {"needs_graph", "graph_type"}, or None when the shape is
+        ambiguous (only numeric columns, no stated intent)
+    """
+    if len(rows) <= 1 or not columns:
+        return {"needs_graph": False, "graph_type": "none"}
+    
+    values = [[row[i] for row in rows if row[i] is not None] for i in range(len(columns))]
+    numeric = [i for i, col in enumerate(values) if col and all(is_numeric(v) for v in col)]
+    labels = [i for i in range(len(columns)) if i not in numeric]
+    if not numeric:
+        return {"needs_graph": False, "graph_type": "none"}
+    
+    # Intent stated in the question wins
+    if TREND_QUESTION_RE.search(question):
+        return {"needs_graph": True, "graph_type": "line"}
+    if SHARE_QUESTION_RE.search(question) and labels and len(rows) <= 8:
+        return {"needs_graph": True, "graph_type": "pie"}
+    if CORRELATION_QUESTION_RE.search(question) and len(numeric) >= 2:
+        return {"needs_graph": True, "graph_type": "scatter"}
+    
+    # Time-like first column -> trend
+    first = values[0]
+    dates_first = first and all(isinstance(v, str) and DATE_VALUE_RE.match(v) for v in first)
+    if DATE_COLUMN_RE.search(columns[0]) or dates_first:
+        return {"needs_graph": True, "graph_type": "line"}
+    
+    if not labels and len(numeric) >= 2:
+        # Only numeric columns: could be a correlation or a ranking
+        return None
+    
+    # Few categories whose value is a share of a whole -> proportions
+    value_col = numeric[-1]
+    total = sum(values[value_col])
+    is_share = (
+        SHARE_COLUMN_RE.search(columns[value_col])
+        or abs(total - 100) < 0.5
+        or abs(total - 1) < 0.005
+    )
+    if labels and len(rows) <= 8 and is_share:
+        return {"needs_graph": True, "graph_type": "pie"}
+    
+    return {"needs_graph": True, "graph_type": "bar"}
+
+JSON_OBJECT_RE = re.compile(r"\{.*\}", re.S)
+
+def extract_json(text: str) -> dict:
+    """Parses the JSON object in an LLM response, ignoring markdown fences or prose around it."""
+    match = JSON_OBJECT_RE.search(text)
+    if not match:
+        raise ValueError(f"No JSON object in response: {text[:100]}")
+    return orjson.loads(match.group())
+
+async def decide_graph_need(state: AgentState) -> AgentState:
+    """Decides if a graph visualization is needed."""
+    print("--- Entered decide_graph_need ---")
+    
+    # Deterministic decision from the question and result shape
+    decision = heuristic_graph_decision(
+        state.get("query_columns", []),
+        state.get("query_result_full", []),
+        state.get("question", ""),
+    )
+    if decision is None and not GRAPH_DECISION_LLM:
+        # Ambiguous numeric-only result: a bar chart of the rows
+        decision = {"needs_graph": True, "graph_type": "bar"}
+    if decision is not None:
+        print(f"Graph Decision (heuristic): {decision}")
+        return decision
+    
+    # GRAPH_DECISION_LLM enabled: ambiguous shapes are left to the LLM
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # If loop is already running (e.g., in Chainlit), create a new one
-            import nest_asyncio
-            nest_asyncio.apply()
-            return asyncio.run(parallel_analysis_and_graph_decision(state))
-        else:
-            return loop.run_until_complete(parallel_analysis_and_graph_decision(state))
-    except RuntimeError:
-        # Fallback to creating new event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            return loop.run_until_complete(parallel_analysis_and_graph_decision(state))
-        finally:
-            loop.close()
+        decision = await GRAPH_CHAIN.ainvoke({
+            "question": state["question"],
+            "result": state["query_result"],
+        })
+    except OutputParserException as e:
+        # Valid JSON but not a GraphDecision (e.g. unknown chart type)
+        print(f"Error parsing graph decision: {e}")
+        return {"needs_graph": False, "graph_type": "none"}
+    
+    print(f"Graph Decision: {decision}")
+    return decision.model_dump()
+
+def figure_to_json(fig) -> str:
+    """Serializes a Plotly figure with orjson (native NumPy support)."""
+    return orjson.dumps(
+        fig.to_plotly_json(),
+        option=orjson.OPT_SERIALIZE_NUMPY,
+        # object-dtype arrays (string labels) are not handled natively
+        default=lambda obj: obj.tolist() if hasattr(obj, "tolist") else str(obj),
+    ).decode()
 
 def viz_agent(state: AgentState) -> AgentState:
     """
     Creates visualizations directly without LLM code generation.
+    
+    Columns are picked by dtype: the last numeric column is plotted against
+    the first non-numeric one (hash IDs are replaced by readable labels).
     """
     print("--- Entered viz_agent ---")
-    result = state["query_result"]
+    result = state.get("query_result_full", [])
     graph_type = state["graph_type"]
     question = state.get("question", "")
     
     try:
-        # Handle string result format from db.run()
-        if isinstance(result, str):
-            # Parse string result back to list of tuples
-            import ast
-            try:
-                result = ast.literal_eval(result)
-            except:
-                print(f"Could not parse result string: {result[:100]}")
-                return {"graph_json": ""}
-        
         # Convert result to DataFrame
         if not result or len(result) == 0:
             return {"graph_json": ""}
         
-        # Determine number of columns
+        # Imported here: pandas/plotly are heavy and only needed for charts
+        import pandas as pd
+        import plotly.express as px
+        
+        # Create DataFrame with the real column names from the query
         first_row = result[0]
         num_cols = len(first_row) if isinstance(first_row, (tuple, list)) else 1
+        columns = state.get("query_columns") or [f'col{i}' for i in range(num_cols)]
+        df = pd.DataFrame.from_records(result, columns=columns)
         
-        # Create column names
-        if num_cols == 1:
-            columns = ['value']
-        elif num_cols == 2:
-            columns = ['label', 'value']
-        elif num_cols == 3:
-            columns = ['id', 'label', 'value']
+        # y = the measure (last numeric column), x = the first other column
+        numeric_cols = list(df.select_dtypes("number").columns)
+        if not numeric_cols:
+            print("Viz skipped: no numeric column to plot")
+            return {"graph_json": ""}
+        y_col = numeric_cols[-1]
+        other_cols = [c for c in df.columns if c not in numeric_cols]
+        if other_cols:
+            x_col = other_cols[0]
+        elif len(df.columns) > 1:
+            x_col = df.columns[0]
         else:
-            columns = [f'col{i}' for i in range(num_cols)]
-        
-        # Create DataFrame
-        df = pd.DataFrame(result, columns=columns)
+            # Single value column: create generic labels
+            df['display_label'] = 'Item ' + (df.index + 1).astype(str)
+            x_col = 'display_label'
         
         # Create readable labels if we have hash IDs
-        if 'label' in df.columns:
-            # Check if labels are long hashes (more than 20 characters)
-            if df['label'].astype(str).str.len().mean() > 20:
-                df['display_label'] = [f'Customer {i+1}' for i in range(len(df))]
-                x_col = 'display_label'
-            else:
-                x_col = 'label'
-        elif 'id' in df.columns:
-            # If we have id column, create readable labels
-            if df['id'].astype(str).str.len().mean() > 20:
-                df['display_label'] = [f'Item {i+1}' for i in range(len(df))]
-                x_col = 'display_label'
-            else:
-                x_col = 'id'
-        else:
-            # Create generic labels
-            df['display_label'] = [f'Item {i+1}' for i in range(len(df))]
+        # Check if labels are long hashes (more than 20 characters) - the
+        # first value is enough, ID columns are uniform
+        if x_col != 'display_label' and len(str(df[x_col].iat[0])) > 20:
+            prefix = 'Customer' if 'customer' in str(x_col).lower() else 'Item'
+            df['display_label'] = f'{prefix} ' + (df.index + 1).astype(str)
             x_col = 'display_label'
         
-        # Determine y column (usually the last numeric column)
-        y_col = 'value' if 'value' in df.columns else df.columns[-1]
-        
         # Create appropriate chart based on graph_type
         if graph_type == "bar":
             fig = px.bar(df, x=x_col, y=y_col, title=f"Bar Chart: {question[:50]}...")
@@ -356,7 +829,7 @@ def viz_agent(state: AgentState) -> AgentState:
             fig = px.bar(df, x=x_col, y=y_col, title=f"Chart: {question[:50]}...")
         
         print(f"Created {graph_type} chart successfully")
-        return {"graph_json": pio.to_json(fig)}
+        return {"graph_json": figure_to_json(fig)}
         
     except Exception as e:
         print(f"Viz Error: {e}")
@@ -367,29 +840,70 @@ def viz_agent(state: AgentState) -> AgentState:
 # --- Graph Construction ---
 
 def check_scope(state: AgentState):
-    if state.get("is_in_scope"):
-        return "sql_agent"
-    return END
+    if not state.get("is_in_scope"):
+        return END
+    # The combined guardrail call may already have produced the query
+    if state.get("sql_query"):
+        return "execute_sql"
+    return "sql_agent"
+
+def failure_agent(state: AgentState):
+    """Reports a query that still fails after the retries (templated, no LLM call)."""
+    print("--- Entered failure_agent ---")
+    return {"final_answer": QUERY_FAILED_ANSWER.format(error=state["error"])}
 
 def should_retry(state: AgentState):
-    if state["error"] and state["iteration"] < 3:
-        return "error_agent"
-    return "parallel_analysis"  # Updated to use parallel execution node
+    if state["error"]:
+        # iteration counts the generation plus each LLM correction; local
+        # lint fixes do not count
+        if state["iteration"] <= MAX_RETRIES:
+            return "error_agent"
+        return "failure_agent"
+    # PARALLEL EXECUTION: both branches only read question/sql_query/query_result,
+    # so LangGraph runs them concurrently in the same superstep (both LLM calls
+    # are async, so they overlap as plain HTTP I/O on the event loop)
+    return ["analysis_agent", "chart_pipeline"]
 
 def should_generate_graph(state: AgentState):
     if state.get("needs_graph"):
         return "viz_agent"
     return END
 
+# Chart branch: graph decision -> visualization. Compiled as its own graph so
+# the chart is built as soon as the decision is in, while analysis_agent is
+# still generating (LangGraph only starts a new superstep once every node
+# of the current one has finished). Its output is limited to the chart keys,
+# so it never writes a key (e.g. final_answer) analysis_agent writes in the
+# same superstep.
+chart_workflow = StateGraph(AgentState, output_schema=ChartOutput)
+
+chart_workflow.add_node("decide_graph_need", decide_graph_need)
+chart_workflow.add_node("viz_agent", viz_agent)
+
+chart_workflow.set_entry_point("decide_graph_need")
+
+chart_workflow.add_conditional_edges(
+    "decide_graph_need",
+    should_generate_graph,
+    {
+        "viz_agent": "viz_agent",
+        END: END
+    }
+)
+
+chart_workflow.add_edge("viz_agent", END)
+
+chart_graph = chart_workflow.compile()
+
 workflow = StateGraph(AgentState)
 
 workflow.add_node("guardrail_agent", guardrail_agent)
 workflow.add_node("sql_agent", sql_agent)
 workflow.add_node("execute_sql", execute_sql)
 workflow.add_node("error_agent", error_agent)
-# PARALLEL OPTIMIZATION: Combined node runs analysis + graph decision concurrently
-workflow.add_node("parallel_analysis", parallel_analysis_and_graph_decision_sync)
-workflow.add_node("viz_agent", viz_agent)
+workflow.add_node("analysis_agent", analysis_agent)
+workflow.add_node("chart_pipeline", chart_graph)
+workflow.add_node("failure_agent", failure_agent)
 
 workflow.set_entry_point("guardrail_agent")
 
@@ -398,6 +912,7 @@ workflow.add_conditional_edges(
     check_scope,
     {
         "sql_agent": "sql_agent",
+        "execute_sql": "execute_sql",
         END: END
     }
 )
@@ -407,24 +922,38 @@ workflow.add_edge("sql_agent", "execute_sql")
 workflow.add_conditional_edges(
     "execute_sql",
     should_retry,
-    {
-        "error_agent": "error_agent",
-        "parallel_analysis": "parallel_analysis"  # Go to parallel node instead of analysis_agent
-    }
+    ["error_agent", "failure_agent", "analysis_agent", "chart_pipeline"]
 )
 
-workflow.add_edge("error_agent", "sql_agent")
+workflow.add_edge("error_agent", "execute_sql")
 
-# After parallel execution, check if graph is needed
-workflow.add_conditional_edges(
-    "parallel_analysis",
-    should_generate_graph,
-    {
-        "viz_agent": "viz_agent",
-        END: END
-    }
-)
-
-workflow.add_edge("viz_agent", END)
+workflow.add_edge("analysis_agent", END)
+workflow.add_edge("chart_pipeline", END)
+workflow.add_edge("failure_agent", END)
 
 app_graph = workflow.compile()
+
+# --- Model Warm-up ---
+
+def warm_up_models():
+    """
+    Loads the Ollama models ahead of the first question (1-token generations).
+    
+    The main model is primed with the SQL prompt rendered without a question:
+    the schema and rules come first in every SQL prompt, so Ollama reuses
+    that prefix from its KV cache and only evaluates the question tokens.
+    """
+    sql_prefix = SQL_CHAIN.first.invoke({"question": ""}).to_string()
+    prompts = [(llm, sql_prefix)]
+    if GRAPH_DECISION_LLM:
+        prompts.append((llm_fast, "ok"))
+    for model, prompt in prompts:
+        try:
+            model.model_copy(update={"num_predict": 1, "cache": False}).invoke(prompt)
+            print(f"Warmed up model: {model.model}")
+        except Exception as e:
+            print(f"Model warm-up failed for {model.model}: {e}")
+
+# Fire-and-forget, so importing the module never waits on Ollama
+if OLLAMA_WARMUP:
+    threading.Thread(target=warm_up_models, name="ollama-warmup", daemon=True).start()